@@ -2,13 +2,14 @@
 
 from __future__ import absolute_import, print_function
 
-from urllib.parse import quote_plus as urlquote_plus
+import json
+from types import MappingProxyType
+from urllib.parse import urlsplit
 
 from twisted.internet import defer
-from twisted.python import log
+from twisted.internet import task
 
-from buildbot.process.properties import Interpolate
-from buildbot.process.properties import Properties
+from buildbot import config
 from buildbot.process.results import CANCELLED
 from buildbot.process.results import EXCEPTION
 from buildbot.process.results import FAILURE
@@ -19,34 +20,63 @@ from buildbot.process.results import WARNINGS
 from buildbot.reporters.base import ReporterBase
 from buildbot.reporters.generators.build import BuildStartEndStatusGenerator
 from buildbot.reporters.message import MessageFormatterRenderable
-from buildbot.util import giturlparse
-from buildbot.util import httpclientservice
 
 from buildbot.process.results import statusToString
-from buildbot.reporters import http, utils
+from buildbot.reporters import utils
+from buildbot.util import toJson
 from buildbot.util.logger import Logger
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 logger = Logger()
 
-STATUS_EMOJIS = {
-    "success": ":sunglassses:",
-    "warnings": ":meow_wow:",
-    "failure": ":skull:",
-    "skipped": ":slam:",
-    "exception": ":skull:",
-    "retry": ":facepalm:",
-    "cancelled": ":slam:",
-}
-STATUS_COLORS = {
-    "success": "#36a64f",
-    "warnings": "#fc8c03",
-    "failure": "#fc0303",
-    "skipped": "#fc8c03",
-    "exception": "#fc0303",
-    "retry": "#fc8c03",
-    "cancelled": "#fc8c03",
-}
+STATUS_EMOJIS = MappingProxyType(
+    {
+        "success": ":sunglassses:",
+        "warnings": ":meow_wow:",
+        "failure": ":skull:",
+        "skipped": ":slam:",
+        "exception": ":skull:",
+        "retry": ":facepalm:",
+        "cancelled": ":slam:",
+    }
+)
+STATUS_COLORS = MappingProxyType(
+    {
+        "success": "#36a64f",
+        "warnings": "#fc8c03",
+        "failure": "#fc0303",
+        "skipped": "#fc8c03",
+        "exception": "#fc0303",
+        "retry": "#fc8c03",
+        "cancelled": "#fc8c03",
+    }
+)
+# same tables indexed by result code, to skip statusToString on lookups
+_RESULT_CODES = (SUCCESS, WARNINGS, FAILURE, SKIPPED, EXCEPTION, RETRY, CANCELLED)
+_EMOJI_BY_CODE = [":facepalm:"] * (max(_RESULT_CODES) + 1)
+_COLOR_BY_CODE = [""] * (max(_RESULT_CODES) + 1)
+for _code in _RESULT_CODES:
+    _EMOJI_BY_CODE[_code] = STATUS_EMOJIS[statusToString(_code)]
+    _COLOR_BY_CODE[_code] = STATUS_COLORS[statusToString(_code)]
+del _code
+_MRKDWN_IN = ("text", "title", "fallback")
 DEFAULT_HOST = "https://hooks.slack.com"  # deprecated
+DEFAULT_BATCH_INTERVAL = 2  # seconds
+DEFAULT_BATCH_SIZE = 20  # attachments merged into a single post
+DEFAULT_MIN_TIME = 1  # seconds between two posts, Slack allows 1 msg/sec
+MAX_QUEUED_REPORTS = 1000  # reports waiting to be formatted or posted
+# committers found for a build's start report are kept for its end report,
+# this only bounds entries whose end report never comes
+USERS_CACHE_TTL = 24 * 3600  # seconds
+
+
+def _merge_key(postData):
+    # messages can only be merged when everything but these keys is the same
+    return {k: v for k, v in postData.items() if k not in ("text", "attachments")}
 
 
 class SlackStatusPush(ReporterBase):
@@ -54,8 +84,19 @@ class SlackStatusPush(ReporterBase):
     neededDetails = dict(wantProperties=True)
 
     def checkConfig(
-        self, endpoint, channel=None, host_url=None, username=None, verbose=False,
-        debug=None, verify=None, generators=None, **kwargs
+        self,
+        endpoint,
+        channel=None,
+        host_url=None,
+        username=None,
+        verbose=False,
+        debug=None,
+        verify=None,
+        generators=None,
+        batch_interval=DEFAULT_BATCH_INTERVAL,
+        batch_size=DEFAULT_BATCH_SIZE,
+        min_time=DEFAULT_MIN_TIME,
+        **kwargs,
     ):
         if not isinstance(endpoint, str):
             logger.warning(
@@ -86,6 +127,22 @@ class SlackStatusPush(ReporterBase):
             logger.warning(
                 "[SlackStatusPush] argument host_url is deprecated and will be removed in the next release: specify the full url as endpoint"
             )
+        # unlike the options above, these break the reporter when wrong
+        if not isinstance(batch_interval, (int, float)) or batch_interval <= 0:
+            config.error(
+                f"[SlackStatusPush] batch_interval must be a positive number, "
+                f"got {batch_interval!r} instead"
+            )
+        if not isinstance(batch_size, int) or batch_size < 1:
+            config.error(
+                f"[SlackStatusPush] batch_size must be a positive integer, "
+                f"got {batch_size!r} instead"
+            )
+        if not isinstance(min_time, (int, float)) or min_time < 0:
+            config.error(
+                f"[SlackStatusPush] min_time must be a non-negative number, "
+                f"got {min_time!r} instead"
+            )
 
     @defer.inlineCallbacks
     def reconfigService(
@@ -97,6 +154,9 @@ class SlackStatusPush(ReporterBase):
         verbose=False,
         debug=None, verify=None, generators=None,
         attachments=True,
+        batch_interval=DEFAULT_BATCH_INTERVAL,
+        batch_size=DEFAULT_BATCH_SIZE,
+        min_time=DEFAULT_MIN_TIME,
         **kwargs
     ):
         self.debug = debug
@@ -118,15 +178,78 @@ class SlackStatusPush(ReporterBase):
         self.channel = channel
         self.username = username
         self.attachments = attachments
+        # keys shared by every message, copied for each build
+        self._post_template = {}
+        if self.channel:
+            self._post_template["channel"] = self.channel
+        url = endpoint
+        if self.baseUrl and not endpoint.startswith("http"):
+            # deprecated
+            url = self.baseUrl + endpoint
+        # keep the same base url for every post so the connection is reused
+        parts = urlsplit(url)
+        self._path = parts.path + ("?" + parts.query if parts.query else "")
+        # imported here so an idle reporter does not load the web client stack
+        from buildbot.util import httpclientservice
+
         self._http = yield httpclientservice.HTTPClientService.getService(
             self.master,
-            self.baseUrl or self.endpoint,
+            f"{parts.scheme}://{parts.netloc}",
             debug=self.debug,
             verify=self.verify,
         )
         self.verbose = verbose
         self.project_ids = {}
 
+        # reports are accumulated here and posted together by _flush
+        if not hasattr(self, "_pending"):
+            self._pending = []
+            self._flush_lock = defer.DeferredLock()
+            # only one post in flight, spaced by at least min_time seconds
+            self._limiter = defer.DeferredSemaphore(1)
+            self._last_post = [float("-inf")]
+            # sendMessage only enqueues, _run_worker does the actual work
+            self._queue = defer.DeferredQueue()
+            self._users_cache = {}  # buildid -> (expires, users)
+        self.min_time = min_time
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        if self.running:
+            # pick up the new batch_interval
+            self._stop_loops()
+            self._start_loops()
+
+    def _start_loops(self):
+        self._flusher = task.LoopingCall(self._flush)
+        self._flusher.clock = self.master.reactor
+        self._flusher.start(self.batch_interval, now=False)
+        self._evicter = task.LoopingCall(self._evict_users_cache)
+        self._evicter.clock = self.master.reactor
+        self._evicter.start(USERS_CACHE_TTL, now=False)
+
+    def _stop_loops(self):
+        for loop in (self._flusher, self._evicter):
+            if loop.running:
+                loop.stop()
+
+    @defer.inlineCallbacks
+    def startService(self):
+        yield super().startService()
+        self._start_loops()
+        self._worker = self._run_worker()
+
+    @defer.inlineCallbacks
+    def stopService(self):
+        self._stop_loops()
+        # stops the consumers and waits for the events being handled, which
+        # may still queue reports
+        yield super().stopService()
+        # let the worker drain the queue, then stop it
+        self._queue.put(None)
+        yield self._worker
+        # do not lose what has been reported since the last flush
+        yield self._flush()
+
     def _create_default_generators(self):
         start_formatter = MessageFormatterRenderable('Build started.')
         end_formatter = MessageFormatterRenderable('Build done.')
@@ -136,65 +259,66 @@ class SlackStatusPush(ReporterBase):
                                          end_formatter=end_formatter)
         ]
 
-    @defer.inlineCallbacks
-    def getAttachments(self, build):
-        sourcestamps = build["buildset"]["sourcestamps"]
+    def getAttachments(self, build, status, color, responsible_users):
+        bset = build["buildset"]
+        buildid = build["buildid"]
+        url = build["url"]
+        parent_id = bset["parent_buildid"]
+        parent_rel = bset.get("parent_relationship")
         attachments = []
 
-        for sourcestamp in sourcestamps:
-            sha = sourcestamp["revision"]
+        # everything but the sourcestamp details is shared by all attachments
+        status_text = f"Status: *{status}*"
+        title_prefix = f"Build #{buildid}"
+        title_suffix = ""
+        sub_build = bool(parent_id)
+        if sub_build:
+            title_suffix = f" {parent_rel}: #{parent_id}"
+        common_fields = []
+        if not sub_build:
+            # Add duration
+            if build["complete"]:
+                duration = self.formatDuration(
+                    build["complete_at"] - build["started_at"]
+                )
+                common_fields.append(
+                    {"title": "Duration", "value": duration, "short": True}
+                )
+            if responsible_users:
+                common_fields.append(
+                    {
+                        "title": "Commiters",
+                        "value": ", ".join(responsible_users),
+                        "short": True,
+                    }
+                )
 
-            title = "Build #{buildid}".format(buildid=build["buildid"])
+        for sourcestamp in bset["sourcestamps"]:
+            sha = sourcestamp["revision"]
             project = sourcestamp["project"]
+            branch = sourcestamp["branch"]
+            repo = sourcestamp["repository"]
+
+            title = title_prefix
             if project:
-                title += " for {project} {sha}".format(project=project, sha=sha)
-            sub_build = bool(build["buildset"]["parent_buildid"])
-            if sub_build:
-                title += " {relationship}: #{parent_build_id}".format(
-                    relationship=build["buildset"]["parent_relationship"],
-                    parent_build_id=build["buildset"]["parent_buildid"],
-                )
+                title += f" for {project} {sha}"
+            title += title_suffix
 
             fields = []
             if not sub_build:
-                branch_name = sourcestamp["branch"]
-                if branch_name:
-                    fields.append(
-                        {"title": "Branch", "value": branch_name, "short": True}
-                    )
-                repositories = sourcestamp["repository"]
-                if repositories:
-                    fields.append(
-                        {"title": "Repository", "value": repositories, "short": True}
-                    )
-                # Add duration
-                if build['complete']:
-                    duration = self.formatDuration(build['complete_at'] - build[
-                        'started_at'])
-                    fields.append(
-                        {"title": "Duration", "value": duration, "short": True}
-                    )
-                responsible_users = yield utils.getResponsibleUsersForBuild(
-                    self.master, build["buildid"]
-                )
-                if responsible_users:
-                    fields.append(
-                        {
-                            "title": "Commiters",
-                            "value": ", ".join(responsible_users),
-                            "short": True,
-                        }
-                    )
+                if branch:
+                    fields.append({"title": "Branch", "value": branch, "short": True})
+                if repo:
+                    fields.append({"title": "Repository", "value": repo, "short": True})
+                fields.extend(common_fields)
             attachments.append(
                 {
                     "title": title,
-                    "title_link": build["url"],
-                    "fallback": "{}: <{}>".format(title, build["url"]),
-                    "text": "Status: *{status}*".format(
-                        status=statusToString(build["results"])
-                    ),
-                    "color": STATUS_COLORS.get(statusToString(build["results"]), ""),
-                    "mrkdwn_in": ["text", "title", "fallback"],
+                    "title_link": url,
+                    "fallback": f"{title}: <{url}>",
+                    "text": status_text,
+                    "color": color,
+                    "mrkdwn_in": _MRKDWN_IN,
                     "fields": fields,
                 }
             )
@@ -219,34 +343,68 @@ class SlackStatusPush(ReporterBase):
 
     @defer.inlineCallbacks
     def getBuildDetailsAndSendMessage(self, build):
+        code = build["results"]
+        if code is not None and 0 <= code < len(_EMOJI_BY_CODE):
+            emoji = _EMOJI_BY_CODE[code]
+            color = _COLOR_BY_CODE[code]
+        else:
+            emoji = ":facepalm:"
+            color = ""
+        status = statusToString(code)
+
         yield utils.getDetailsForBuild(self.master, build, **self.neededDetails)
+        # committers are only shown in the attachments of top level builds
+        if not self.attachments or build["buildset"]["parent_buildid"]:
+            users_d = defer.succeed([])
+        else:
+            users_d = self._getResponsibleUsers(build)
+        # the query runs while the message is built
         text = yield self.getMessage(build)
-        postData = {}
+        responsible_users = yield users_d
+        postData = self._post_template.copy()
         if self.attachments:
-            attachments = yield self.getAttachments(build)
+            attachments = self.getAttachments(build, status, color, responsible_users)
             if attachments:
                 postData["attachments"] = attachments
-        else:
+        elif text:
             text += " here: " + build["url"]
-        postData["text"] = text
-
-        if self.channel:
-            postData["channel"] = self.channel
+        if text:
+            postData["text"] = text
 
-        postData["icon_emoji"] = STATUS_EMOJIS.get(
-            statusToString(build["results"]), ":facepalm:"
-        )
+        postData["icon_emoji"] = emoji
         extra_params = yield self.getExtraParams(build)
         postData.update(extra_params)
         return postData
 
+    @defer.inlineCallbacks
+    def _getResponsibleUsers(self, build):
+        buildid = build["buildid"]
+        now = self.master.reactor.seconds()
+        # the end report is the last one of the build, its entry can go
+        if build["complete"]:
+            entry = self._users_cache.pop(buildid, None)
+        else:
+            entry = self._users_cache.get(buildid)
+        if entry and entry[0] > now:
+            return entry[1]
+        users = yield utils.getResponsibleUsersForBuild(self.master, buildid)
+        if not build["complete"]:
+            self._users_cache[buildid] = (now + USERS_CACHE_TTL, users)
+        return users
+
+    def _evict_users_cache(self):
+        now = self.master.reactor.seconds()
+        for buildid, (expires, _) in list(self._users_cache.items()):
+            if expires <= now:
+                del self._users_cache[buildid]
+
     def getMessage(self, build):
         event_messages = {
             False: "Buildbot started build %s" % build["builder"]["name"],
             True: "Buildbot finished build %s with result: %s"
             % (build["builder"]["name"], statusToString(build["results"])),
         }
-        return event_messages.get(build['complete'], "")
+        return event_messages.get(build["complete"])
 
     # returns a Deferred that returns None
     def buildStarted(self, reports):
@@ -259,39 +417,146 @@ class SlackStatusPush(ReporterBase):
     def getExtraParams(self, build):
         return {}
 
-    @defer.inlineCallbacks
     def sendMessage(self, reports):
-        report = reports[0]
-        build = report['builds'][0]
-        postData = yield self.getBuildDetailsAndSendMessage(build)
-        if not postData:
+        # bound both the reports waiting for the worker and the messages
+        # waiting for _flush; this is done here rather than with
+        # DeferredQueue(size=...) so that stopService can always enqueue the
+        # worker's stop marker
+        if len(self._queue.pending) + len(self._pending) >= MAX_QUEUED_REPORTS:
+            logger.error(
+                "too many pending reports, dropping report for build {buildid}",
+                buildid=reports[0]["builds"][0]["buildid"],
+            )
+        else:
+            self._queue.put(reports)
+        return defer.succeed(None)
+
+    @defer.inlineCallbacks
+    def _run_worker(self):
+        while True:
+            reports = yield self._queue.get()
+            if reports is None:
+                return
+            try:
+                yield self._do_send(reports)
+            except Exception as e:
+                logger.error("Failed to build status message: {error}", error=e)
+
+    def _do_send(self, reports):
+        build = reports[0]["builds"][0]
+        d = self.getBuildDetailsAndSendMessage(build)
+        d.addCallback(self._queue_post, build)
+        return d
+
+    def _queue_post(self, postData, build):
+        if not postData.get("text") and not postData.get("attachments"):
+            # nothing worth a round trip to Slack
             return
 
-        sourcestamps = build["buildset"]["sourcestamps"]
+        # one message per build whatever the number of sourcestamps, the
+        # loop is only there for diagnostics
+        for sourcestamp in build["buildset"]["sourcestamps"]:
+            if sourcestamp["revision"] is None:
+                logger.info(
+                    "no special revision for {repo}", repo=sourcestamp["repository"]
+                )
 
-        for sourcestamp in sourcestamps:
-            sha = sourcestamp["revision"]
-            if sha is None:
-                logger.info("no special revision for this")
+        self._pending.append(postData)
 
-            logger.info("posting to {url}", url=self.endpoint)
-            try:
-                if self.baseUrl:
-                    # deprecated
-                    response = yield self._http.post(self.endpoint, json=postData)
-                else:
-                    response = yield self._http.post("", json=postData)
-                if response.code != 200:
-                    content = yield response.content()
-                    logger.error(
-                        "{code}: unable to upload status: {content}",
-                        code=response.code,
-                        content=content,
-                    )
-            except Exception as e:
+    def _take_batch(self):
+        """Pop the next pending messages that can be posted together.
+
+        Only consecutive messages with the same channel, icon_emoji and other
+        extra keys are merged, so messages are posted in the order they were
+        reported. A batch holds at most batch_size attachments (a message
+        without attachments counts as one). The first pending message is
+        always taken, even when it has more attachments than that.
+        """
+        key = _merge_key(self._pending[0])
+        taken = 0
+        count = 0
+        for postData in self._pending:
+            size = len(postData.get("attachments", ())) or 1
+            if taken and (
+                count + size > self.batch_size or _merge_key(postData) != key
+            ):
+                break
+            taken += 1
+            count += size
+        batch = self._pending[:taken]
+        del self._pending[:taken]
+        return batch
+
+    def _merge(self, batch):
+        """Merge several messages into a single Slack payload.
+
+        Texts are joined line by line and attachments are concatenated, the
+        other keys are the same for every message of the batch.
+        """
+        if len(batch) == 1:
+            return batch[0]
+        merged = dict(batch[0])
+        text = "\n".join(p["text"] for p in batch if p.get("text"))
+        if text:
+            merged["text"] = text
+        attachments = [a for p in batch for a in p.get("attachments", [])]
+        if attachments:
+            merged["attachments"] = attachments
+        return merged
+
+    def _encode(self, obj):
+        # same output as HTTPClientService's json= argument, datetimes
+        # become epoch ints
+        if orjson is not None:
+            return orjson.dumps(
+                obj, default=toJson, option=orjson.OPT_PASSTHROUGH_DATETIME
+            )
+        return json.dumps(obj, default=toJson).encode("utf-8")
+
+    def _rate_limited_post(self, postData):
+        reactor = self.master.reactor
+        delay = max(0, self.min_time - (reactor.seconds() - self._last_post[0]))
+        kwargs = dict(
+            data=self._encode(postData), headers={"Content-Type": "application/json"}
+        )
+        if delay:
+            d = task.deferLater(reactor, delay, self._http.post, self._path, **kwargs)
+        else:
+            d = defer.maybeDeferred(self._http.post, self._path, **kwargs)
+        d.addBoth(self._posted)
+        return d
+
+    def _posted(self, result):
+        # success or failure, the post counts for the rate limit
+        self._last_post[0] = self.master.reactor.seconds()
+        return result
+
+    def _flush(self):
+        return self._flush_lock.run(self._post_pending)
+
+    @defer.inlineCallbacks
+    def _post_pending(self):
+        # the limiter spaces the posts, no need to wait for the next tick
+        while self._pending:
+            yield self._post_batch(self._take_batch())
+
+    @defer.inlineCallbacks
+    def _post_batch(self, batch):
+        postData = self._merge(batch)
+
+        logger.info("posting to {url}", url=self.endpoint)
+        try:
+            response = yield self._limiter.run(self._rate_limited_post, postData)
+            if response.code != 200:
+                content = yield response.content()
                 logger.error(
-                    "Failed to send status for {repo} at {sha}: {error}",
-                    repo=sourcestamp["repository"],
-                    sha=sha,
-                    error=e,
+                    "{code}: unable to upload status: {content}",
+                    code=response.code,
+                    content=content,
                 )
+        except Exception as e:
+            logger.error(
+                "Failed to send status for {count} build(s): {error}",
+                count=len(batch),
+                error=e,
+            )
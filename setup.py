@@ -17,6 +17,7 @@ setup(
     long_description_content_type="text/markdown",
     packages=["buildbot_slack"],
     install_requires=["buildbot (>=2.0.0)", "treq (>=18.6)"],
+    extras_require={"orjson": ["orjson"]},
     entry_points={
         "buildbot.reporters": [
             "SlackStatusPush = buildbot_slack.reporter:SlackStatusPush"
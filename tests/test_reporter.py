@@ -0,0 +1,403 @@
+import datetime
+import json
+
+from twisted.internet import defer
+from twisted.trial import unittest
+
+from buildbot import config
+from buildbot.process.results import FAILURE
+from buildbot.process.results import SUCCESS
+from buildbot.reporters import utils
+from buildbot.reporters.base import ReporterBase
+from buildbot.test.fake import fakemaster
+from buildbot.util import httpclientservice
+
+try:
+    from buildbot.test.reactor import TestReactorMixin
+except ImportError:  # buildbot < 3.0
+    from buildbot.test.util.misc import TestReactorMixin
+
+from buildbot_slack import reporter
+from buildbot_slack.reporter import SlackStatusPush
+
+ENDPOINT = "https://hooks.slack.com/services/T/B/X"
+
+
+class FakeResponse:
+    code = 200
+
+    def content(self):
+        return defer.succeed(b"ok")
+
+
+class FakeHTTP:
+    """Records the posts instead of sending them."""
+
+    def __init__(self):
+        self.posts = []
+
+    def post(self, ep, data=None, headers=None):
+        self.posts.append((ep, json.loads(data), headers))
+        return defer.succeed(FakeResponse())
+
+
+class TestSlackStatusPush(TestReactorMixin, unittest.TestCase):
+    def setUp(self):
+        self.setup_test_reactor()
+        self.master = fakemaster.make_master(self, wantMq=True)
+        self.http = FakeHTTP()
+        self.base_urls = []
+
+        def getService(master, base_url, **kwargs):
+            self.base_urls.append(base_url)
+            return defer.succeed(self.http)
+
+        self.patch(httpclientservice.HTTPClientService, "getService", getService)
+
+        # build details are filled in by the tests, only count the queries
+        self.details = []
+        self.patch(utils, "getDetailsForBuild", self.getDetailsForBuild)
+        self.users_queries = []
+        self.patch(utils, "getResponsibleUsersForBuild", self.getResponsibleUsers)
+
+    def getDetailsForBuild(self, master, build, **kwargs):
+        d = self.details.pop(0) if self.details else defer.succeed(None)
+        return d
+
+    def getResponsibleUsers(self, master, buildid):
+        self.users_queries.append(buildid)
+        return defer.succeed(["me@foo"])
+
+    @defer.inlineCallbacks
+    def setupReporter(self, **kwargs):
+        self.sp = SlackStatusPush(ENDPOINT, **kwargs)
+        yield self.sp.setServiceParent(self.master)
+        yield self.master.startService()
+
+    def makeBuild(self, buildid=20, results=SUCCESS, complete=True, sourcestamps=1):
+        started_at = datetime.datetime(2020, 1, 1, 12, 0, 0)
+        return {
+            "buildid": buildid,
+            "url": f"http://localhost:8080/#/builders/79/builds/{buildid}",
+            "results": results if complete else None,
+            "complete": complete,
+            "started_at": started_at,
+            "complete_at": started_at + datetime.timedelta(seconds=4),
+            "builder": {"name": "Builder0"},
+            "buildset": {
+                "parent_buildid": None,
+                "parent_relationship": None,
+                "sourcestamps": [
+                    {
+                        "revision": "d34db33fd43db33f",
+                        "project": "testProject",
+                        "branch": "master",
+                        "repository": "https://example.org/repo",
+                    }
+                ]
+                * sourcestamps,
+            },
+        }
+
+    def report(self, build):
+        return self.sp.sendMessage([{"builds": [build]}])
+
+    @defer.inlineCallbacks
+    def test_post_to_endpoint_path(self):
+        yield self.setupReporter(channel="#builds")
+        yield self.report(self.makeBuild())
+        self.reactor.advance(2)
+
+        self.assertEqual(self.base_urls, ["https://hooks.slack.com"])
+        self.assertEqual(len(self.http.posts), 1)
+        ep, postData, headers = self.http.posts[0]
+        self.assertEqual(ep, "/services/T/B/X")
+        self.assertEqual(headers, {"Content-Type": "application/json"})
+        self.assertEqual(postData["channel"], "#builds")
+        self.assertEqual(postData["icon_emoji"], ":sunglassses:")
+        self.assertEqual(
+            postData["text"], "Buildbot finished build Builder0 with result: success"
+        )
+        self.assertEqual(
+            postData["attachments"],
+            [
+                {
+                    "title": "Build #20 for testProject d34db33fd43db33f",
+                    "title_link": "http://localhost:8080/#/builders/79/builds/20",
+                    "fallback": "Build #20 for testProject d34db33fd43db33f: "
+                    "<http://localhost:8080/#/builders/79/builds/20>",
+                    "text": "Status: *success*",
+                    "color": "#36a64f",
+                    "mrkdwn_in": ["text", "title", "fallback"],
+                    "fields": [
+                        {"title": "Branch", "value": "master", "short": True},
+                        {
+                            "title": "Repository",
+                            "value": "https://example.org/repo",
+                            "short": True,
+                        },
+                        {"title": "Duration", "value": "0m 4s", "short": True},
+                        {"title": "Commiters", "value": "me@foo", "short": True},
+                    ],
+                }
+            ],
+        )
+
+    @defer.inlineCallbacks
+    def test_merge_batch(self):
+        yield self.setupReporter()
+        yield self.report(self.makeBuild(20))
+        yield self.report(self.makeBuild(21))
+        self.reactor.advance(2)
+
+        self.assertEqual(len(self.http.posts), 1)
+        postData = self.http.posts[0][1]
+        self.assertEqual(
+            postData["text"],
+            "Buildbot finished build Builder0 with result: success\n"
+            "Buildbot finished build Builder0 with result: success",
+        )
+        self.assertEqual(
+            [a["title_link"] for a in postData["attachments"]],
+            [
+                "http://localhost:8080/#/builders/79/builds/20",
+                "http://localhost:8080/#/builders/79/builds/21",
+            ],
+        )
+
+    @defer.inlineCallbacks
+    def test_no_merge_with_different_keys(self):
+        yield self.setupReporter()
+        channels = {20: "#a", 21: "#b", 22: "#a", 23: "#a", 24: "#a"}
+        self.sp.getExtraParams = lambda build: {"channel": channels[build["buildid"]]}
+        yield self.report(self.makeBuild(20))
+        yield self.report(self.makeBuild(21))
+        yield self.report(self.makeBuild(22))
+        yield self.report(self.makeBuild(23))
+        yield self.report(self.makeBuild(24, results=FAILURE))
+        # each post waits min_time after the previous one
+        for _ in range(4):
+            self.reactor.advance(2)
+
+        self.assertEqual(
+            [
+                (p["channel"], p["icon_emoji"], len(p["attachments"]))
+                for _, p, _ in self.http.posts
+            ],
+            [
+                ("#a", ":sunglassses:", 1),
+                ("#b", ":sunglassses:", 1),
+                ("#a", ":sunglassses:", 2),
+                ("#a", ":skull:", 1),
+            ],
+        )
+
+    @defer.inlineCallbacks
+    def test_posts_in_report_order(self):
+        yield self.setupReporter(min_time=0)
+        yield self.report(self.makeBuild(20))
+        yield self.report(self.makeBuild(21, complete=False))
+        yield self.report(self.makeBuild(21))
+        self.reactor.advance(2)
+
+        self.assertEqual(
+            [p["text"] for _, p, _ in self.http.posts],
+            [
+                "Buildbot finished build Builder0 with result: success",
+                "Buildbot started build Builder0",
+                "Buildbot finished build Builder0 with result: success",
+            ],
+        )
+        self.assertEqual(
+            [p["attachments"][0]["title_link"][-2:] for _, p, _ in self.http.posts],
+            ["20", "21", "21"],
+        )
+
+    @defer.inlineCallbacks
+    def test_batch_size_counts_attachments(self):
+        yield self.setupReporter(batch_size=3, min_time=0)
+        yield self.report(self.makeBuild(20, sourcestamps=2))
+        yield self.report(self.makeBuild(21, sourcestamps=2))
+        self.reactor.advance(2)
+
+        self.assertEqual([len(p["attachments"]) for _, p, _ in self.http.posts], [2, 2])
+
+    @defer.inlineCallbacks
+    def test_one_batch_per_interval(self):
+        yield self.setupReporter(batch_interval=5)
+        yield self.report(self.makeBuild(20))
+        self.reactor.advance(4)
+        self.assertEqual(self.http.posts, [])
+        self.reactor.advance(1)
+        self.assertEqual(len(self.http.posts), 1)
+
+        yield self.report(self.makeBuild(21))
+        self.reactor.advance(4)
+        self.assertEqual(len(self.http.posts), 1)
+        self.reactor.advance(1)
+        self.assertEqual(len(self.http.posts), 2)
+
+    @defer.inlineCallbacks
+    def test_min_time_spacing(self):
+        yield self.setupReporter(batch_size=1, min_time=10)
+        yield self.report(self.makeBuild(20))
+        yield self.report(self.makeBuild(21))
+        yield self.report(self.makeBuild(22))
+        self.reactor.advance(2)
+        self.assertEqual(len(self.http.posts), 1)
+        self.reactor.advance(9)
+        self.assertEqual(len(self.http.posts), 1)
+        self.reactor.advance(1)
+        self.assertEqual(len(self.http.posts), 2)
+        self.reactor.advance(10)
+        self.assertEqual(len(self.http.posts), 3)
+
+    @defer.inlineCallbacks
+    def test_drop_when_queue_full(self):
+        self.patch(reporter, "MAX_QUEUED_REPORTS", 2)
+        yield self.setupReporter()
+        # the worker is stuck on the first report, the next two are queued
+        details = defer.Deferred()
+        self.details.append(details)
+        for buildid in (20, 21, 22, 23):
+            yield self.report(self.makeBuild(buildid))
+        details.callback(None)
+        self.reactor.advance(2)
+
+        self.assertEqual(
+            [a["title_link"][-2:] for a in self.http.posts[0][1]["attachments"]],
+            ["20", "21", "22"],
+        )
+        # pending messages count as well
+        for buildid in (24, 25, 26):
+            yield self.report(self.makeBuild(buildid))
+        self.reactor.advance(2)
+        self.assertEqual(
+            [a["title_link"][-2:] for a in self.http.posts[1][1]["attachments"]],
+            ["24", "25"],
+        )
+
+    @defer.inlineCallbacks
+    def test_stop_drains_queue(self):
+        yield self.setupReporter()
+        details = defer.Deferred()
+        self.details.append(details)
+        yield self.report(self.makeBuild(20))
+        yield self.report(self.makeBuild(21))
+        d = self.master.stopService()
+        self.assertNoResult(d)
+        details.callback(None)
+        yield d
+
+        self.assertEqual(len(self.http.posts), 1)
+        self.assertEqual(len(self.http.posts[0][1]["attachments"]), 2)
+
+    @defer.inlineCallbacks
+    def test_stop_keeps_reports_of_pending_events(self):
+        yield self.setupReporter()
+        stopService = ReporterBase.stopService
+
+        @defer.inlineCallbacks
+        def stopServiceWithPendingEvent(sp):
+            yield self.report(self.makeBuild(20))
+            yield stopService(sp)
+
+        self.patch(ReporterBase, "stopService", stopServiceWithPendingEvent)
+        yield self.master.stopService()
+
+        self.assertEqual(len(self.http.posts), 1)
+        self.assertEqual(self.sp._queue.pending, [])
+
+    @defer.inlineCallbacks
+    def test_users_cache_until_finished(self):
+        yield self.setupReporter()
+        yield self.report(self.makeBuild(20, complete=False))
+        # longer than any batch or rate limit delay
+        self.reactor.advance(3600)
+        yield self.report(self.makeBuild(20))
+        self.assertEqual(self.users_queries, [20])
+        self.assertEqual(self.sp._users_cache, {})
+
+    @defer.inlineCallbacks
+    def test_users_cache_expiry(self):
+        yield self.setupReporter()
+        yield self.report(self.makeBuild(20, complete=False))
+        self.assertEqual(list(self.sp._users_cache), [20])
+
+        self.reactor.advance(reporter.USERS_CACHE_TTL)
+        self.assertEqual(self.sp._users_cache, {})
+        yield self.report(self.makeBuild(20))
+        self.assertEqual(self.users_queries, [20, 20])
+
+    @defer.inlineCallbacks
+    def test_no_users_query_without_attachments(self):
+        yield self.setupReporter(attachments=False)
+        yield self.report(self.makeBuild(20))
+        self.reactor.advance(2)
+
+        self.assertEqual(self.users_queries, [])
+        self.assertEqual(
+            self.http.posts[0][1]["text"],
+            "Buildbot finished build Builder0 with result: success here: "
+            "http://localhost:8080/#/builders/79/builds/20",
+        )
+
+    @defer.inlineCallbacks
+    def test_skip_empty_message(self):
+        yield self.setupReporter(attachments=False)
+        build = self.makeBuild(20)
+        build["complete"] = None
+        yield self.report(build)
+        self.reactor.advance(2)
+
+        self.assertEqual(self.http.posts, [])
+
+    @defer.inlineCallbacks
+    def test_datetime_extra_params(self):
+        yield self.setupReporter()
+        self.sp.getExtraParams = lambda build: {
+            "ts": datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc)
+        }
+        yield self.report(self.makeBuild(20))
+        self.reactor.advance(2)
+
+        self.assertEqual(self.http.posts[0][1]["ts"], 1577836800)
+
+    def test_encode_without_orjson(self):
+        self.patch(reporter, "orjson", None)
+        self.assertEqual(SlackStatusPush._encode(None, {"a": [1, 2]}), b'{"a": [1, 2]}')
+
+    @defer.inlineCallbacks
+    def test_restart(self):
+        yield self.setupReporter()
+        yield self.master.stopService()
+        yield self.master.startService()
+        yield self.report(self.makeBuild(20))
+        self.reactor.advance(2)
+
+        self.assertEqual(len(self.http.posts), 1)
+        self.assertEqual(self.sp._pending, [])
+
+    @defer.inlineCallbacks
+    def test_reconfig_batch_interval(self):
+        yield self.setupReporter()
+        yield self.sp.reconfigServiceWithSibling(
+            SlackStatusPush(ENDPOINT, batch_interval=10)
+        )
+        yield self.report(self.makeBuild(20))
+        self.reactor.advance(9)
+        self.assertEqual(self.http.posts, [])
+        self.reactor.advance(1)
+        self.assertEqual(len(self.http.posts), 1)
+
+    def test_invalid_batch_options(self):
+        for kwargs in (
+            dict(batch_interval=0),
+            dict(batch_interval="2"),
+            dict(batch_size=0),
+            dict(batch_size=2.5),
+            dict(min_time=-1),
+            dict(min_time="1"),
+        ):
+            with self.assertRaises(config.ConfigErrors):
+                SlackStatusPush(ENDPOINT, **kwargs)